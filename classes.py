@@ -1,35 +1,60 @@
+import heapq
 import queue
 import re
+import selectors
+import socket
 import threading
 import time
 from datetime import datetime, timedelta
-from typing import Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 # Third party
-import schedule
 from loguru import logger
 
 # Local
 import settings as s
-from fields import StringField
+from fields import NullStringField, StringField
 from models import User
-from sql import fetch_all_rows_sql, fetch_one_row_sql
-from utils import get_users_from_slack
+from sql import basic_sql_query_many, fetch_all_rows_sql
+from utils import get_users_from_slack, open_slack_channel
+
+# Matches a direct mention (@botname that is at the beginning) in message text
+# Based on https://www.fullstackpython.com/blog/build-first-slack-bot-python.html
+# but only allows valid Slack IDs, so that user input can't make it backtrack
+_MENTION_RE = re.compile(r"^<@([WU][A-Z0-9]{1,20})>(.*)", re.IGNORECASE)
+# Longer messages are not parsed for mentions
+_MAX_MENTION_LENGTH = 8192
+
+# Matches the commands our bot understands, add new commands as named groups
+_COMMAND_RE = re.compile(r"^(?P<play>" + re.escape(s.PLAY_GAME) + r")\b", re.IGNORECASE)
+
+
+def send_message(user: User, message: str) -> None:
+    """
+    Queue a direct message to a user, SlackSender opens their channel
+    if we haven't messaged them before.
+    """
+    s.SLACK_OUTBOX_Q.put(
+        {"user": user.slack_id, "channel": user.slack_channel, "text": message}
+    )
 
 
 class SlackEvent:
     """
     A SlackEvent is just a message within Slack. Currently
-    we only care about the message user and their message.
+    we only care about the message user and their message, along
+    with the channel for direct messages.
     """
 
     # Strict type enforcing on fields
     user = StringField(upper_case=True)
     message = StringField()
+    channel = NullStringField(upper_case=True)
 
-    def __init__(self, user: str, message: str) -> None:
+    def __init__(self, user: str, message: str, channel: str = None) -> None:
         self.user = user
         self.message = message
+        self.channel = channel
 
     @staticmethod
     def parse_direct_mention(
@@ -39,23 +64,26 @@ class SlackEvent:
         Finds a direct mention (@botname that is at the
         beginning) in message text.
         """
-        # From https://www.fullstackpython.com/blog/build-first-slack-bot-python.html
-        MENTION_REGEX = "^<@(|[WU].+?)>(.*)"
-        matches = re.search(MENTION_REGEX, message_text, re.IGNORECASE)
+        if len(message_text) > _MAX_MENTION_LENGTH:
+            return (None, None)
+        # Pattern is anchored, so match is enough
+        matches = _MENTION_RE.match(message_text)
         return (matches.group(1), matches.group(2).strip()) if matches else (None, None)
 
     @staticmethod
     def is_direct_message(channel: str) -> bool:
         """
         See if a message was a direct message (IM/whisper) to our bot.
+        We only get messages from channels our bot is in, so any direct
+        message channel (their IDs start with D) is with our bot.
         """
-        # Create query
-        sql = "SELECT * FROM users WHERE slack_channel = ?"
-        user = fetch_one_row_sql(sql, (channel,))
-        return bool(user)
+        return channel.startswith("D")
 
     def __repr__(self) -> str:
-        return f"{self.__class__.__name__}({self.user!r}, {self.message!r})"
+        return (
+            f"{self.__class__.__name__}"
+            f"({self.user!r}, {self.message!r}, {self.channel!r})"
+        )
 
 
 class MonitorSlack(threading.Thread):
@@ -67,6 +95,8 @@ class MonitorSlack(threading.Thread):
     def __init__(self) -> None:
         super(MonitorSlack, self).__init__()
         self._stop_event = threading.Event()
+        # Lets stop wake us up while we wait for Slack
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
 
     def queue_slack_events(self) -> None:
         """
@@ -77,28 +107,59 @@ class MonitorSlack(threading.Thread):
         If its not a direct mention or whisper to our bot, ignore event
         """
         slack_events = s.SLACK_CLIENT.rtm_read()
-        for event in slack_events:
-            if event.get("type") == "message" and "subtype" not in event:
-                # Queue event if its a direct mention or direct message
-                user_id, message = SlackEvent.parse_direct_mention(event["text"])
+        messages = [
+            event
+            for event in slack_events
+            if event.get("type") == "message" and "subtype" not in event
+        ]
+        if not messages:
+            return
+
+        for event in messages:
+            # Queue event if its a direct mention or direct message
+            text = event["text"]
+            # Cheap check to skip the mention regex for most messages
+            if text.startswith("<@"):
+                user_id, message = SlackEvent.parse_direct_mention(text)
                 if user_id == s.STAFF_BOT_ID and message:
                     direct_mention = SlackEvent(event["user"], message)
                     s.SLACK_EVENTS_Q.put(direct_mention)
-                elif SlackEvent.is_direct_message(event["channel"]):
-                    direct_message = SlackEvent(event["user"], event["text"])
-                    s.SLACK_EVENTS_Q.put(direct_message)
+                    continue
+            channel = event["channel"]
+            if SlackEvent.is_direct_message(channel):
+                direct_message = SlackEvent(event["user"], text, channel)
+                s.SLACK_EVENTS_Q.put(direct_message)
 
     @logger.catch
     def run(self) -> None:
+        selector = selectors.DefaultSelector()
+        selector.register(self._wakeup_receiver, selectors.EVENT_READ)
+        sock = None
         while True:
-            self.queue_slack_events()
-            time.sleep(s.SLACK_RTM_READ_DELAY)
+            # Slack client replaces the socket when it reconnects
+            current_sock = s.SLACK_CLIENT.server.websocket.sock
+            if current_sock is not sock:
+                if sock is not None:
+                    selector.unregister(sock)
+                selector.register(current_sock, selectors.EVENT_READ)
+                sock = current_sock
+            # Block until Slack sends us something or we are stopped, time
+            # out regularly so that we keep the connection alive
+            selector.select(timeout=s.SLACK_RTM_READ_TIMEOUT)
             # Check if we need to quit
             if self.stopped():
+                selector.close()
+                self._wakeup_receiver.close()
+                self._wakeup_sender.close()
                 break
+            self.queue_slack_events()
 
     def stop(self) -> None:
+        # Run closes our wakeup sockets once it has stopped
+        if self.stopped():
+            return
         self._stop_event.set()
+        self._wakeup_sender.send(b"\0")
 
     def stopped(self) -> bool:
         return self._stop_event.is_set()
@@ -120,6 +181,7 @@ class ProcessQueue(threading.Thread):
         If the user currently has a challenge, we resolve it,
         see if they guessed correctly and inform them accordingly.
         """
+        guess = event.message.strip().casefold()
         # Get their current challenge
         challenge_user = User.get(slack_id=user.challenge)
         if not challenge_user:
@@ -127,20 +189,16 @@ class ProcessQueue(threading.Thread):
             logger.error(
                 f"{event.user} has broken challenge: {user.challenge}, users not in the DB?"
             )
-        elif event.message.lower() in challenge_user.all_names:
+        elif guess in challenge_user.all_names:
             message = "Yes! You got it!"
             logger.info(f"{event.user} guessed {user.challenge} correctly.")
         else:
             message = f"Nope, sorry, its: {challenge_user.first_name}"
-            logger.info(
-                f"{event.user} guessed {user.challenge} incorrectly: {event.message}"
-            )
+            logger.info(f"{event.user} guessed {user.challenge} incorrectly: {guess}")
 
         # Remove challenge and inform user
-        user.challenge = None
-        user.challenge_datetime = None
-        user.save()
-        s.SLACK_CLIENT.rtm_send_message(user.slack_channel, message)
+        user.clear_challenge()
+        send_message(user, message)
 
     def issue_challenge(self, event: SlackEvent, user: User) -> None:
         """
@@ -148,56 +206,77 @@ class ProcessQueue(threading.Thread):
         a new challenge if they request one. We rotate through
         all users once randomly per round.
         """
+        command = _COMMAND_RE.match(event.message)
         # See if they want to play the guessing game
-        if event.message.startswith(s.PLAY_GAME):
-            all_users = user.get_all_valid_users()
-            if not all_users:
+        if command and command.lastgroup == "play":
+            new_challenge = user.get_next_challenge()
+            if not new_challenge:
                 logger.error(f"There are no valid users on the Slack server.")
                 message = "We couldn't detect any valid users on your Slack server, make sure they have profile pictures!"
-                s.SLACK_CLIENT.rtm_send_message(user.slack_channel, message)
+                send_message(user, message)
                 return
-            new_challenge = user.get_next_challenge()
             # Get user from DB
             new_challenge_user = User.get(slack_id=new_challenge)
             if new_challenge_user:
-                user.challenge = new_challenge
-                user.challenge_datetime = datetime.utcnow()
-                user.save()
+                user.set_challenge(new_challenge_user.slack_id, datetime.utcnow())
                 message = f"Who is this:\n {new_challenge_user.photo_url}"
-                s.SLACK_CLIENT.rtm_send_message(user.slack_channel, message)
+                send_message(user, message)
             else:
                 logger.error(
                     f"{event.user} has received broken challenge: {user.challenge}"
                 )
                 message = "Something went wrong with issuing your new challenge, please try again later!"
-                s.SLACK_CLIENT.rtm_send_message(user.slack_channel, message)
+                send_message(user, message)
         # They are not currently in a round, and they gave us a command we dont understand
         else:
             message = f"I'm not sure what you mean, please try *{s.PLAY_GAME}*."
             logger.info(
                 f"{user.slack_id} does not know what they are doing: {event.message}"
             )
-            s.SLACK_CLIENT.rtm_send_message(user.slack_channel, message)
+            send_message(user, message)
+
+    def handle_event(self, event: SlackEvent, user: Optional[User]) -> None:
+        """
+        Resolve or issue a challenge for the user that sent the event.
+        """
+        # Save the channel of users that message us first, so that we
+        # don't need to open it
+        if user and event.channel and not user.slack_channel:
+            user.set_channel(event.channel)
+        if user and user.challenge:
+            self.resolve_challenge(event, user)
+        elif user:
+            self.issue_challenge(event, user)
+        else:
+            logger.error(f"Event for a user that doesn't exist in DB: {event}")
+
+    def process_events(self, events: List[SlackEvent]) -> None:
+        """
+        Process a batch of events, fetching all their users at once.
+        """
+        users = User.get_many([event.user for event in events])
+        for event in events:
+            # Users with more than one event in the batch need to be fetched
+            # again, as the previous event could have changed them
+            user = users.pop(event.user, None) or User.get(slack_id=event.user)
+            self.handle_event(event, user)
 
     @logger.catch
     def run(self) -> None:
         while True:
             # Blocking, will wait for new events to get added
-            # Add a graceful timeout so that we can safely kill thread
-            event = None
+            # Then grab any other waiting events so we can process them together
+            events = [s.SLACK_EVENTS_Q.get()]
             try:
-                event = s.SLACK_EVENTS_Q.get(timeout=s.QUEUE_TIMEOUT)
+                while len(events) < s.EVENTS_BATCH_SIZE:
+                    events.append(s.SLACK_EVENTS_Q.get_nowait())
             except queue.Empty:
                 pass
 
-            if event:
-                user = User.get(slack_id=event.user)
-                if user and user.challenge:
-                    self.resolve_challenge(event, user)
-                elif user:
-                    self.issue_challenge(event, user)
-                else:
-                    logger.error(f"Event for a user that doesn't exist in DB: {event}")
+            # Stop adds None to the queue to wake us up
+            events = [event for event in events if event]
+            if events:
+                self.process_events(events)
 
             # Check if we need to quit
             if self.stopped():
@@ -205,6 +284,7 @@ class ProcessQueue(threading.Thread):
 
     def stop(self) -> None:
         self._stop_event.set()
+        s.SLACK_EVENTS_Q.put(None)
 
     def stopped(self) -> bool:
         return self._stop_event.is_set()
@@ -224,56 +304,130 @@ class ScheduleThread(threading.Thread):
         """
         Delete the challenge if user took too long to respond
         """
-        # Get all current challenges
+        # Get all overdue challenges along with who they were for
         sql = """
             SELECT
-                slack_id, challenge, challenge_datetime
+                users.slack_id, users.slack_channel,
+                challenge_users.slack_id, challenge_users.full_name
             FROM
                 users
+            LEFT JOIN users AS challenge_users
+                ON challenge_users.slack_id = users.challenge
             WHERE
-                challenge IS NOT NULL;
+                users.challenge IS NOT NULL
+                AND users.challenge_datetime <= ?;
             """
-        challenges = fetch_all_rows_sql(sql)
-        for challenge in challenges:
-            user = challenge[0]
-            challenge_user = challenge[1]
-            challenge_time = datetime.strptime(challenge[2], "%Y-%m-%d %H:%M:%S.%f")
-            challenge_deadline = challenge_time + timedelta(seconds=s.CHALLENGE_TIMEOUT)
-            # This challenge is overdue, we must remove it
-            if challenge_deadline <= datetime.utcnow():
-                challenge_user = User.get(slack_id=challenge_user)
-                user = User.get(slack_id=user)
-                if user and challenge_user:
-                    user.challenge = None
-                    user.challenge_datetime = None
-                    user.save()
-                    message = f"Sorry, you took to long to respond, it is: {challenge_user.first_name}"
-                    logger.info(
-                        f"{user.slack_id} took too long to respond, it is: {challenge_user.slack_id}"
-                    )
-                    s.SLACK_CLIENT.rtm_send_message(user.slack_channel, message)
-
-                else:
-                    logger.error(
-                        f"Can't clear stale challenges, users dont exist in DB"
-                    )
+        deadline = datetime.utcnow() - timedelta(seconds=s.CHALLENGE_TIMEOUT)
+        challenges = fetch_all_rows_sql(sql, (deadline,))
+        expired = []
+        for user, slack_channel, challenge_user, full_name in challenges:
+            if not challenge_user:
+                logger.error(f"Can't clear stale challenges, users dont exist in DB")
+                continue
+            expired.append(user)
+            challenge_user = User(slack_id=challenge_user, full_name=full_name)
+            message = f"Sorry, you took to long to respond, it is: {challenge_user.first_name}"
+            logger.info(
+                f"{user} took too long to respond, it is: {challenge_user.slack_id}"
+            )
+            s.SLACK_OUTBOX_Q.put(
+                {"user": user, "channel": slack_channel, "text": message}
+            )
+
+        # Remove all overdue challenges in a single transaction
+        if expired:
+            sql = """
+                UPDATE
+                    users
+                SET
+                    challenge = NULL, challenge_datetime = NULL
+                WHERE
+                    slack_id = ?;
+                """
+            basic_sql_query_many(sql, [(user,) for user in expired])
+            User.invalidate(*expired)
+
+    @logger.catch
+    def run(self) -> None:
+        # Register the scheduled tasks as (next run, order, interval, task),
+        # kept in a heap so that we know which task is due next
+        now = time.monotonic()
+        tasks = [
+            # Clear stale challenges every 5 seconds
+            (now + 5, 0, 5, self.clear_challenges),
+            # Update Slack users data every hour
+            (now + 3600, 1, 3600, get_users_from_slack),
+        ]
+        heapq.heapify(tasks)
+        while True:
+            # Sleep until the next task is due, stop wakes us up immediately
+            next_run, order, interval, task = tasks[0]
+            if self._stop_event.wait(max(next_run - time.monotonic(), 0)):
+                break
+            task()
+            heapq.heapreplace(
+                tasks, (time.monotonic() + interval, order, interval, task)
+            )
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def stopped(self) -> bool:
+        return self._stop_event.is_set()
+
+
+class SlackSender(threading.Thread):
+    """
+    Sends messages from our outbox Queue to Slack, so that
+    the threads handling challenges never wait on Slack.
+    """
+
+    def __init__(self) -> None:
+        super(SlackSender, self).__init__()
+        self._stop_event = threading.Event()
+
+    def open_channel(self, slack_id: str) -> Optional[str]:
+        """
+        Open a direct channel with a user we haven't messaged before, and
+        save it so that we only need to ask Slack once.
+        """
+        user = User.get(slack_id=slack_id)
+        if not user:
+            return None
+        # We could have opened it for an earlier message
+        if user.slack_channel:
+            return user.slack_channel
+        channel = open_slack_channel(slack_id)
+        if channel:
+            user.set_channel(channel)
+        return channel
+
+    @logger.catch
+    def send(self, payload: Dict[str, str]) -> None:
+        """
+        Send a single message, a message that fails is logged and dropped
+        so that we keep sending the rest.
+        """
+        channel = payload["channel"] or self.open_channel(payload["user"])
+        if channel:
+            s.SLACK_CLIENT.rtm_send_message(channel, payload["text"])
 
     @logger.catch
     def run(self) -> None:
-        # Register the scheduled tasks
-        schedule.every(5).seconds.do(self.clear_challenges)
-        # Update Slack users data every hour
-        schedule.every().hour.do(get_users_from_slack)
         while True:
-            # Run all pending tasks every second
-            schedule.run_pending()
-            time.sleep(1)
+            # Blocking, will wait for new messages to get added
+            # Stop adds None to the queue to wake us up
+            payload = s.SLACK_OUTBOX_Q.get()
+            if payload:
+                self.send(payload)
+
             # Check if we need to quit
             if self.stopped():
                 break
 
     def stop(self) -> None:
         self._stop_event.set()
+        s.SLACK_OUTBOX_Q.put(None)
 
     def stopped(self) -> bool:
         return self._stop_event.is_set()
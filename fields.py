@@ -1,81 +1,79 @@
 import re
 from datetime import datetime
+from typing import TYPE_CHECKING, Any
 
+# See https://emailregex.com/
+_EMAIL_RE = re.compile(r"[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+", re.IGNORECASE)
 
-class BoolField:
+
+class Field:
+    """
+    Base field, only validates values as they are set. Doesn't define
+    __get__ at runtime, so values are read straight from the instance
+    __dict__ without going through the descriptor.
+    """
+
+    name: str
+
+    if TYPE_CHECKING:
+
+        def __get__(self, instance, owner) -> Any:
+            """Only seen by type checkers, so field values are typed."""
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+
+class BoolField(Field):
     """Bool field, sets default to None if not specified."""
 
     def __init__(self, default=None):
-        if type(default) != bool and default is not None:
+        if not isinstance(default, bool) and default is not None:
             raise ValueError(f"BoolField default must be boolean <{type(default)}>")
         self.default = default
 
-    def __get__(self, instance, owner):
-        return instance.__dict__[self.name]
-
     def __set__(self, instance, value):
-        if type(value) != bool and value is not None:
+        if not isinstance(value, bool) and value is not None:
             raise ValueError(f"Field must be bool <{self.name}: {value}>")
         if value is not None:
             instance.__dict__[self.name] = value
         else:
             instance.__dict__[self.name] = self.default
 
-    def __set_name__(self, owner, name):
-        self.name = name
 
-
-class NullEmailField:
+class NullEmailField(Field):
     """Email stored as string that can be null. Always lower case."""
 
-    def __get__(self, instance, owner):
-        return instance.__dict__[self.name]
-
     def __set__(self, instance, value):
         instance.__dict__[self.name] = None
 
-        if value and type(value) != str:
+        if value and not isinstance(value, str):
             raise ValueError(f"Email Field must be string <{self.name}: {value}>")
 
         if value:
-            # See https://emailregex.com/
-            value = re.search(
-                r"[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+", value, re.IGNORECASE
-            )
+            value = _EMAIL_RE.search(value)
 
         if value:
             instance.__dict__[self.name] = value.group(0).lower()
 
-    def __set_name__(self, owner, name):
-        self.name = name
 
-
-class NullDateTimeField:
+class NullDateTimeField(Field):
     """Datetime field that can be null."""
 
-    def __get__(self, instance, owner):
-        return instance.__dict__[self.name]
-
     def __set__(self, instance, value):
-        if value and type(value) != datetime:
+        if value and not isinstance(value, datetime):
             raise ValueError(f"Field must be datetime <{self.name}: {value}>")
         instance.__dict__[self.name] = value
 
-    def __set_name__(self, owner, name):
-        self.name = name
 
-
-class NullStringField:
+class NullStringField(Field):
     """String field that can be null, defaults lower case with optional upper case"""
 
     def __init__(self, upper_case=False):
         self.upper_case = upper_case
 
-    def __get__(self, instance, owner):
-        return instance.__dict__[self.name]
-
     def __set__(self, instance, value):
-        if value and type(value) != str:
+        if value and not isinstance(value, str):
             raise ValueError(f"Field must be string or null <{self.name}: {value}>")
         if not value:
             instance.__dict__[self.name] = None
@@ -84,25 +82,16 @@ class NullStringField:
                 value.lower() if not self.upper_case else value.upper()
             )
 
-    def __set_name__(self, owner, name):
-        self.name = name
 
-
-class StringField:
+class StringField(Field):
     """String field, cannot be null, defaults lower case with optional upper case"""
 
     def __init__(self, upper_case=False):
         self.upper_case = upper_case
 
-    def __get__(self, instance, owner):
-        return instance.__dict__[self.name]
-
     def __set__(self, instance, value):
-        if not value or type(value) != str:
+        if not value or not isinstance(value, str):
             raise ValueError(f"Field must be string <{self.name}: {value}>")
         instance.__dict__[self.name] = (
             value.lower() if not self.upper_case else value.upper()
         )
-
-    def __set_name__(self, owner, name):
-        self.name = name
@@ -1,9 +1,24 @@
-import random
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
-from typing import Any, Iterable, List, Optional, Set, Union
+from functools import lru_cache
+from operator import attrgetter
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 from urllib.parse import unquote_plus
 
 # Local
+import settings as s
 from fields import (
     NullDateTimeField,
     NullEmailField,
@@ -11,7 +26,43 @@ from fields import (
     StringField,
     BoolField,
 )
-from sql import basic_sql_query, fetch_all_rows_sql, fetch_one_row_sql
+from sql import (
+    basic_sql_query,
+    basic_sql_query_many,
+    basic_sql_transaction,
+    epoch_to_datetime,
+    fetch_all_rows_sql,
+    fetch_iter_sql,
+    fetch_one_row_sql,
+)
+
+# Recently fetched database rows by slack_id, with the time they were fetched.
+# Rows are cached rather than User objects so that cached users can't be
+# modified by callers. Version is bumped on every invalidation, so that we
+# don't cache rows that were read before a write.
+_USER_CACHE: "OrderedDict[str, Tuple[float, Tuple]]" = OrderedDict()
+_USER_CACHE_LOCK = threading.Lock()
+_USER_CACHE_VERSION = 0
+
+
+@lru_cache(maxsize=s.USER_CACHE_SIZE)
+def _parse_names(
+    full_name: Optional[str], pref_name: Optional[str]
+) -> Tuple[Optional[str], FrozenSet[str]]:
+    """
+    Work out a user's first name and the set of case folded names they could
+    be known as for the guessing game. Cached by name, as users are created
+    from the database for every event.
+    """
+    names: Set = set()
+    first_name = None
+    if full_name:
+        full_names = full_name.split()
+        first_name = full_names[0].title() if full_names else None
+        names.update(full_names)
+    if pref_name:
+        names.update(pref_name.split())
+    return first_name, frozenset(name.casefold() for name in names)
 
 
 class User:
@@ -46,6 +97,35 @@ class User:
         "challenge_datetime",
         "can_play_game",
     )
+    # Attributes that come from the user's Slack profile
+    profile_attributes = all_attributes[:7]
+    # Get all attributes in order at once, for saving into the database
+    _get_attributes = attrgetter(*all_attributes)
+    _get_profile = attrgetter(*profile_attributes)
+    # Select columns in the same order as our attributes, regardless of
+    # the order of columns in the table
+    _select_sql = f"SELECT {', '.join(all_attributes)} FROM users"
+    _select_by_id_sql = f"{_select_sql} WHERE slack_id = ?"
+    _select_by_email_sql = f"{_select_sql} WHERE email = ?"
+    _select_profiles_sql = f"SELECT {', '.join(profile_attributes)} FROM users"
+    _delete_sql = "DELETE FROM users WHERE slack_id = ?"
+    # Insert user, or update all their values if they already exist. Allows us
+    # to create query without worrying about number of attributes on the user.
+    # Direct channels never change, so one opened while the user was being
+    # synced is kept
+    _upsert_sql = (
+        f"INSERT INTO users ({', '.join(all_attributes)}) "
+        f"VALUES (?{', ?' * (len(all_attributes) - 1)}) "
+        "ON CONFLICT(slack_id) DO UPDATE SET "
+        + ", ".join(
+            (
+                f"{attribute} = COALESCE(excluded.{attribute}, users.{attribute})"
+                if attribute == "slack_channel"
+                else f"{attribute} = excluded.{attribute}"
+            )
+            for attribute in all_attributes
+        )
+    )
 
     def __init__(self, **kwargs: Any) -> None:
         # Initialise remaining fields with None, downside is
@@ -61,87 +141,122 @@ class User:
 
     @property
     def first_name(self) -> Optional[str]:
-        return self.full_name.split().pop(0).title() if self.full_name else None
+        return _parse_names(self.full_name, self.pref_name)[0]
 
     @property
-    def all_names(self) -> Set[str]:
+    def all_names(self) -> FrozenSet[str]:
         """
         Return set of names that user could be known as for the guessing
-        game.
+        game. Names are case folded.
+        """
+        return _parse_names(self.full_name, self.pref_name)[1]
+
+    @property
+    def profile(self) -> Tuple:
+        """
+        The user's attributes that come from their Slack profile.
         """
-        names: Set = set()
-        if self.full_name:
-            names.update(self.full_name.split())
-        if self.pref_name:
-            names.update(self.pref_name.split())
-        return names
+        return self._get_profile(self)
 
-    def _serialise(self) -> List[Any]:
+    def _serialise(self) -> Tuple:
         """
-        Convert user into list of its attributes for saving into
+        Convert user into tuple of its attributes for saving into
         database.
         """
-        return [self[attribute] for attribute in self.all_attributes]
+        return self._get_attributes(self)
 
     @classmethod
     def _deserialise(cls, data: Iterable[Any]) -> "User":
         """
         Convert list of user attributes from database into User object.
+        Values were validated when the user was saved, so they are set
+        directly without going through the fields again.
         """
-        user_data = {}
-        for attribute, value in zip(cls.all_attributes, data):
-            user_data[attribute] = value
+        user = cls.__new__(cls)
+        user_data = user.__dict__
+        user_data.update(zip(cls.all_attributes, data))
         # Ensure datetime field is parsed correctly
         if user_data["challenge_datetime"]:
-            user_data["challenge_datetime"] = datetime.strptime(
-                user_data["challenge_datetime"], "%Y-%m-%d %H:%M:%S.%f"
+            user_data["challenge_datetime"] = epoch_to_datetime(
+                user_data["challenge_datetime"]
             )
-        if user_data["can_play_game"] == 1:
-            user_data["can_play_game"] = True
-        else:
-            user_data["can_play_game"] = False
-        return User(**user_data)
-
-    def _update(self, user: "User") -> None:
-        """
-        Update database fields on User objects, it requires that the user
-        already exists in the database.
-        """
-        for attribute in self.all_attributes:
-            user[attribute] = None
-            if self[attribute]:
-                user[attribute] = self[attribute]
-        # Create list of variables for the update query
-        updated_values = user._serialise()
-        # This is required to specify which user is being updated in the query below
-        updated_values.append(user.slack_id)
-
-        # Allows us to create query without worrying about number of attributes on the user
-        sql = f"UPDATE users SET {' = ?, '.join(self.all_attributes)} = ? WHERE slack_id = ?"
-        basic_sql_query(sql, updated_values)
+        user_data["can_play_game"] = user_data["can_play_game"] == 1
+        return user
 
     def save(self) -> None:
         """
         Save user to the database. If they already exist, we will update
         the values that have changed.
         """
-        user = User.get(slack_id=self.slack_id)
-        if user:
-            self._update(user)
-        else:
-            # Allows us to create query without worrying about number of attributes on the user
-            number_of_attributes = len(self.all_attributes) - 1
-            sql = f"INSERT INTO users {self.all_attributes} VALUES(?{', ?' * number_of_attributes})"
-            basic_sql_query(sql, self._serialise())
+        basic_sql_query(self._upsert_sql, self._serialise())
+        User.invalidate(self.slack_id)
+
+    @classmethod
+    def bulk_save(cls, users: Iterable["User"]) -> None:
+        """
+        Save multiple users to the database in a single transaction.
+        """
+        users = list(users)
+        if not users:
+            return
+        basic_sql_query_many(cls._upsert_sql, [user._serialise() for user in users])
+        User.invalidate(*[user.slack_id for user in users])
+
+    @staticmethod
+    def bulk_set_can_play_game(results: Iterable[Tuple[str, bool]]) -> None:
+        """
+        Update whether users (slack_id, can_play_game) are valid for the
+        guessing game, all in a single transaction. Only touches that
+        column, so that challenges issued in the meantime are kept.
+        """
+        params = [(can_play_game, slack_id) for slack_id, can_play_game in results]
+        if not params:
+            return
+        sql = "UPDATE users SET can_play_game = ? WHERE slack_id = ?"
+        basic_sql_query_many(sql, params)
+        User.invalidate(*[param[1] for param in params])
+
+    @classmethod
+    def get_saved_profiles(cls) -> Set[Tuple]:
+        """
+        Retrieve the Slack profiles of all users saved in the database,
+        compare with User.profile to see if a user has changed.
+        """
+        return set(fetch_all_rows_sql(cls._select_profiles_sql))
+
+    @classmethod
+    def bulk_delete(cls, slack_ids: Iterable[str]) -> None:
+        """
+        Delete multiple users, and their challenges, from the database.
+        Users that don't exist are ignored.
+        """
+        params = [(slack_id,) for slack_id in slack_ids]
+        if not params:
+            return
+        # Challenges reference the user, so they have to go first
+        basic_sql_query_many("DELETE FROM challenges WHERE slack_id = ?", params)
+        basic_sql_query_many(cls._delete_sql, params)
+        User.invalidate(*[param[0] for param in params])
 
     def delete(self) -> None:
         """
-        Delete user from the database if it exists.
+        Delete user, and their challenges, from the database if it exists.
         """
-        user = User.get(slack_id=self.slack_id)
-        if user:
-            sql = "DELETE FROM users WHERE slack_id = ?"
-            basic_sql_query(sql, (user.slack_id,))
+        User.bulk_delete([self.slack_id])
+
+    @staticmethod
+    def invalidate(*slack_ids: str) -> None:
+        """
+        Remove users from the cache after they have been changed in the
+        database. Clears the whole cache if no users are given.
+        """
+        global _USER_CACHE_VERSION
+        with _USER_CACHE_LOCK:
+            _USER_CACHE_VERSION += 1
+            if not slack_ids:
+                _USER_CACHE.clear()
+            for slack_id in slack_ids:
+                _USER_CACHE.pop(slack_id, None)
 
     @staticmethod
     def get(slack_id: str = None, email: str = None) -> Union["User", None]:
@@ -153,66 +268,131 @@ class User:
         search_param = slack_id if slack_id else email
         if not search_param:
             return None
+
+        # See if we've recently fetched this user
+        if slack_id:
+            with _USER_CACHE_LOCK:
+                cached = _USER_CACHE.get(slack_id)
+                version = _USER_CACHE_VERSION
+                if cached and time.monotonic() - cached[0] < s.USER_CACHE_TIMEOUT:
+                    _USER_CACHE.move_to_end(slack_id)
+                else:
+                    cached = None
+            if cached:
+                return User._deserialise(cached[1])
+
         # Create query based on search parameter
-        sql = "SELECT * FROM users WHERE slack_id = ?"
+        sql = User._select_by_id_sql
         if not slack_id:
-            sql = "SELECT * FROM users WHERE email = ?"
+            sql = User._select_by_email_sql
         user = fetch_one_row_sql(sql, (search_param,))
 
+        if user and slack_id:
+            with _USER_CACHE_LOCK:
+                # Skip caching if the user could have changed since we read it
+                if version == _USER_CACHE_VERSION:
+                    _USER_CACHE[slack_id] = (time.monotonic(), user)
+                    _USER_CACHE.move_to_end(slack_id)
+                    if len(_USER_CACHE) > s.USER_CACHE_SIZE:
+                        _USER_CACHE.popitem(last=False)
+
         return User._deserialise(user) if user else None
 
     @classmethod
-    def get_all_users(cls) -> List[Any]:
-        """
-        Retrieve all users that exist in the database.
-        """
-        sql = "SELECT * FROM users"
-        users = fetch_all_rows_sql(sql)
-        return [cls._deserialise(user) for user in users]
-
-    def get_all_valid_users(self) -> List[Any]:
-        """
-        Retrieve all other users that exist in the database,
-        that are valid for the guessing game. Excludes self.
-        """
-        sql = f"SELECT slack_id FROM users WHERE slack_id NOT LIKE '{self.slack_id}' AND can_play_game = 1"
-        users = fetch_all_rows_sql(sql)
-        return [user[0] for user in users]
-
-    def get_next_challenge(self) -> str:
-        """
-        Get the users next random challenge.
-        If they have gone through all users, then clear
-        their challenges and start a new round.
-        """
-        all_users = self.get_all_valid_users()
-        sql = """
-            SELECT
-                challenges.challenge
-            FROM
-                challenges
-            INNER JOIN users ON users.slack_id = challenges.slack_id
-            WHERE
-                users.slack_id = ?;
-            """
-        current_challenges = fetch_all_rows_sql(sql, (self.slack_id,))
-        # Returns list of tuples, need to convert to list
-        current_challenges = [challenge[0] for challenge in current_challenges]
-        # Exclude users that have already been guessed this round
-        available_challenges: Union[set, list] = set(all_users).difference(
-            set(current_challenges)
+    def get_many(cls, slack_ids: Iterable[str]) -> Dict[str, "User"]:
+        """
+        Retrieve multiple users from database with a single query,
+        returns dict of the users that exist by their slack_id.
+        """
+        slack_ids = list(set(slack_ids))
+        if not slack_ids:
+            return {}
+        sql = f"{cls._select_sql} WHERE slack_id IN (?{', ?' * (len(slack_ids) - 1)})"
+        users = fetch_all_rows_sql(sql, slack_ids)
+        return {user[0]: cls._deserialise(user) for user in users}
+
+    @classmethod
+    def get_all_users(cls) -> Iterator["User"]:
+        """
+        Retrieve all users that exist in the database. Users are read
+        and created as they are iterated over.
+        """
+        sql = cls._select_sql
+        for user in fetch_iter_sql(sql):
+            yield cls._deserialise(user)
+
+    @staticmethod
+    def get_saved_channels() -> Dict[str, str]:
+        """
+        Retrieve the direct channels we have saved for all users,
+        by their slack_id.
+        """
+        sql = (
+            "SELECT slack_id, slack_channel FROM users WHERE slack_channel IS NOT NULL"
         )
-        if not available_challenges:
+        return dict(fetch_all_rows_sql(sql))
+
+    def get_next_challenge(self) -> Optional[str]:
+        """
+        Get the users next random challenge, use set_challenge to
+        issue it. If they have gone through all users, then clear
+        their challenges and start a new round. Returns None if there
+        are no other users that are valid for the guessing game.
+        """
+        # Pick a random valid user that hasn't been guessed this round
+        sql = (
+            "SELECT users.slack_id FROM users "
+            "LEFT JOIN challenges ON challenges.challenge = users.slack_id "
+            "AND challenges.slack_id = ? "
+            "WHERE users.slack_id != ? AND users.can_play_game = 1 "
+            "AND challenges.challenge IS NULL "
+            "ORDER BY RANDOM() LIMIT 1"
+        )
+        challenge = fetch_one_row_sql(sql, (self.slack_id, self.slack_id))
+        if not challenge:
             # New round - need to reset challenges
-            sql = "DELETE FROM challenges WHERE slack_id = ?"
-            basic_sql_query(sql, (self.slack_id,))
-            available_challenges = all_users[:]
-        new_challenge = random.sample(available_challenges, 1).pop()
-        # Save new challenge
-        sql = f"INSERT INTO challenges (slack_id, challenge) VALUES(?, ?)"
-        data = (self.slack_id, new_challenge)
-        basic_sql_query(sql, data)
-        return new_challenge
+            delete_sql = "DELETE FROM challenges WHERE slack_id = ?"
+            basic_sql_query(delete_sql, (self.slack_id,))
+            challenge = fetch_one_row_sql(sql, (self.slack_id, self.slack_id))
+        return challenge[0] if challenge else None
+
+    def set_challenge(self, challenge: str, challenge_datetime: datetime) -> None:
+        """
+        Issue a new challenge to the user, saves it to this round's
+        challenges and the user in one transaction.
+        """
+        self.challenge = challenge
+        self.challenge_datetime = challenge_datetime
+        insert_sql = "INSERT INTO challenges (slack_id, challenge) VALUES(?, ?)"
+        update_sql = (
+            "UPDATE users SET challenge = ?, challenge_datetime = ? WHERE slack_id = ?"
+        )
+        basic_sql_transaction(
+            [
+                (insert_sql, (self.slack_id, self.challenge)),
+                (update_sql, (self.challenge, self.challenge_datetime, self.slack_id)),
+            ]
+        )
+        User.invalidate(self.slack_id)
+
+    def set_channel(self, slack_channel: str) -> None:
+        """
+        Save the direct channel we opened for the user.
+        """
+        self.slack_channel = slack_channel
+        sql = "UPDATE users SET slack_channel = ? WHERE slack_id = ?"
+        basic_sql_query(sql, (self.slack_channel, self.slack_id))
+        User.invalidate(self.slack_id)
+
+    def clear_challenge(self) -> None:
+        """
+        Remove the user's current challenge.
+        """
+        self.challenge = None
+        self.challenge_datetime = None
+        sql = "UPDATE users SET challenge = NULL, challenge_datetime = NULL WHERE slack_id = ?"
+        basic_sql_query(sql, (self.slack_id,))
+        User.invalidate(self.slack_id)
 
     @staticmethod
     def parse_slack_data(data: dict) -> Optional["User"]:
@@ -224,20 +404,19 @@ class User:
         user_id = data.get("id")
         if not user_id or not profile:
             return None
-        user = User(slack_id=user_id)
-        user.email = profile.get("email")
-        # Set this to None string if it doesnt exist
-        user.full_name = profile.get("real_name_normalized", "None")
-        user.pref_name = profile.get("display_name_normalized")
-        user.phone = profile.get("phone")
         profile_image = profile.get("image_192")
         encoded_profile_image = profile_image.split("&d=")[-1]
-        user.photo_url = unquote_plus(encoded_profile_image)
-        # New or updated user, dont modify challenges
-        user.challenge = None
-        user.challenge_datetime = None
-
-        return user
+        # Build all values first so that each field is only set once, new or
+        # updated users are created without challenges
+        return User(
+            slack_id=user_id,
+            email=profile.get("email"),
+            # Set this to None string if it doesnt exist
+            full_name=profile.get("real_name_normalized", "None"),
+            pref_name=profile.get("display_name_normalized"),
+            phone=profile.get("phone"),
+            photo_url=unquote_plus(encoded_profile_image),
+        )
 
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}({self.slack_id!r}, {self.full_name!r})"
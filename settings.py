@@ -4,43 +4,70 @@ Global settings and constants for the project
 import os
 import queue
 from pathlib import Path
+from types import SimpleNamespace
 
 # Third Party
+import requests
+import slackclient.client
+import slackclient.server
+import slackclient.slackrequest
 from dotenv import load_dotenv
 from loguru import logger
+from requests.adapters import HTTPAdapter
 from slackclient import SlackClient
 
 from typing import Any, Optional
 
+# Optional, faster JSON decoding of Slack API responses if it is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
 # Get secrets from local .env file.
 load_dotenv()
 
 # File locations
 LOG_LOCATION: Path = Path.cwd() / "log" / "bot.log"
 DATABASE_LOCATION: Path = Path.cwd() / "data" / "bot.sqlite"
+SLACK_USERS_CACHE_LOCATION: Path = Path.cwd() / "data" / "slack_users.json"
 
 # Used to connect to Slack API
 SLACK_BOT_OAUTH_ACCESS_TOKEN: Optional[str] = os.getenv("SLACK_BOT_OAUTH_ACCESS_TOKEN")
 # Init Slack events queue
 SLACK_EVENTS_Q: queue.Queue = queue.Queue()
+# Init queue of messages waiting to be sent to Slack
+SLACK_OUTBOX_Q: queue.Queue = queue.Queue(maxsize=1024)
 
 # Bot's Slack client and user ID: assigned after the bot starts up
 SLACK_CLIENT: Any = None
 STAFF_BOT_ID: Optional[str] = None
 
-# Delay in seconds between checking Slack real time session for new events
-# Use a lower value for larger servers or if you experience delays in responses.
-SLACK_RTM_READ_DELAY = 0.05
-# Queue get is blocking, we want a time in seconds out if we need to bail. Useful for
-# safe shutdown of bot.
-QUEUE_TIMEOUT = 5
+# Max time in seconds to wait for new events on the Slack real time session
+# before reading it anyway. Events are read as soon as they arrive.
+SLACK_RTM_READ_TIMEOUT = 5
+# How many times to retry Slack Web API calls when it rate limits us.
+SLACK_API_RETRIES = 5
+# Max number of queued events to process together.
+EVENTS_BATCH_SIZE = 32
 # How long in seconds do users have to guess challenge before it times out. Will be
 # a range that has additional 10 seconds on top of this time.
 CHALLENGE_TIMEOUT = 30
 
+# How many users to keep cached in memory and for how long in seconds, saves a
+# database round trip when the same users message the bot repeatedly.
+USER_CACHE_SIZE = 1024
+USER_CACHE_TIMEOUT = 60
+# How long in seconds to reuse our cached copy of the users on Slack, saves
+# fetching them again on restarts. Kept below the hourly sync so that syncs
+# still pick up changes, set to 0 to disable.
+SLACK_USERS_CACHE_TIMEOUT = 50 * 60
+
 # Command used to start a new guessing game
 PLAY_GAME = "play"
 ENABLE_FACE_DETECTION = True
+# Number of avatars to download and check for faces at the same time
+FACE_DETECTION_WORKERS = 8
 
 
 def slack_init() -> None:
@@ -65,6 +92,20 @@ def slack_init() -> None:
         compression="gz",  # Compress rotated logs
     )
 
+    # Slack client posts every API call with a new connection, give it
+    # a session so that HTTPS connections to Slack are kept alive
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    slackclient.slackrequest.requests = session
+    # Slack client decodes every API response three times and encodes it
+    # once, use orjson for this if we have it
+    if orjson:
+        fast_json = SimpleNamespace(
+            loads=orjson.loads, dumps=lambda obj: orjson.dumps(obj).decode()
+        )
+        slackclient.client.json = fast_json
+        slackclient.server.json = fast_json
+
     # Connect to Slack
     SLACK_CLIENT = SlackClient(SLACK_BOT_OAUTH_ACCESS_TOKEN)
     assert SLACK_CLIENT.rtm_connect(
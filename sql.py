@@ -1,5 +1,7 @@
 import sqlite3
-from typing import Any, Iterable, List, Optional, Tuple
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
 
 # Local
 import settings as s
@@ -7,20 +9,83 @@ import settings as s
 # Sqlite3 does not currently support path objects
 database = str(s.DATABASE_LOCATION)
 
+# Datetimes (UTC) are stored as milliseconds since epoch, which is cheaper
+# to compare and convert than formatted strings
+EPOCH = datetime(1970, 1, 1)
+MILLISECOND = timedelta(milliseconds=1)
+
+
+def datetime_to_epoch(value: datetime) -> int:
+    """
+    Convert a UTC datetime to milliseconds since epoch for the database.
+    """
+    return (value - EPOCH) // MILLISECOND
+
+
+def epoch_to_datetime(value: int) -> datetime:
+    """
+    Convert milliseconds since epoch from the database to a UTC datetime.
+    """
+    return EPOCH + value * MILLISECOND
+
+
+sqlite3.register_adapter(datetime, datetime_to_epoch)
+
+
+# Each thread keeps its own connection open, so that we don't pay for
+# opening the database and preparing statements on every query
+_local = threading.local()
+
+
+def connect() -> sqlite3.Connection:
+    """
+    Connect to the database, reusing this thread's connection if it
+    has one. Uses WAL mode so that readers don't block writers, and only
+    syncs to disk at checkpoints instead of every commit. It enforces
+    foreign key constraints.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(database, cached_statements=256)
+        conn.execute("PRAGMA journal_mode = WAL;")
+        conn.execute("PRAGMA synchronous = NORMAL;")
+        conn.execute("PRAGMA temp_store = MEMORY;")
+        conn.execute("PRAGMA mmap_size = 134217728;")
+        conn.execute("PRAGMA foreign_keys = ON;")
+        _local.conn = conn
+    return conn
+
 
 def basic_sql_query(sql: str, data: Iterable) -> None:
     """
-    Basic SQL query that connects, commits and closes off
-    the connection. It enforces foreign key constraints.
+    Basic SQL query that commits, or rolls back if it fails.
     Supports most of the basic queries that doesnt expect
     a response (INSERT, UPDATE, DELETE).
     """
-    conn = sqlite3.connect(database)
-    cur = conn.cursor()
-    cur.execute("PRAGMA foreign_keys = ON;")
-    cur.execute(sql, data)
-    conn.commit()
-    conn.close()
+    conn = connect()
+    with conn:
+        conn.execute(sql, data)
+
+
+def basic_sql_query_many(sql: str, data: Iterable[Iterable]) -> None:
+    """
+    Runs a basic SQL query for every item in data, all in a single
+    transaction.
+    """
+    conn = connect()
+    with conn:
+        conn.executemany(sql, data)
+
+
+def basic_sql_transaction(queries: Iterable[Tuple[str, Iterable]]) -> None:
+    """
+    Runs multiple basic SQL queries (sql, data) in a single transaction,
+    so that they are committed together.
+    """
+    conn = connect()
+    with conn:
+        for sql, data in queries:
+            conn.execute(sql, data)
 
 
 def fetch_one_row_sql(sql: str, data: Iterable) -> Optional[Tuple]:
@@ -28,12 +93,7 @@ def fetch_one_row_sql(sql: str, data: Iterable) -> Optional[Tuple]:
     SQL query that retrieves a single row
     from database.
     """
-    conn = sqlite3.connect(database)
-    cur = conn.cursor()
-    cur.execute(sql, data)
-    row = cur.fetchone()
-    conn.close()
-    return row
+    return connect().execute(sql, data).fetchone()
 
 
 def fetch_all_rows_sql(sql: str, data: Iterable[Any] = []) -> List[Any]:
@@ -42,12 +102,20 @@ def fetch_all_rows_sql(sql: str, data: Iterable[Any] = []) -> List[Any]:
     from database with optional data
     to be substitued into query.
     """
-    conn = sqlite3.connect(database)
-    cur = conn.cursor()
-    cur.execute(sql, data)
-    rows = cur.fetchall()
-    conn.close()
-    return [row for row in (rows or [])]
+    return connect().execute(sql, data).fetchall()
+
+
+def fetch_iter_sql(
+    sql: str, data: Iterable[Any] = [], size: int = 500
+) -> Iterator[Tuple]:
+    """
+    SQL query that retrieves all rows from database with optional
+    data to be substitued into query. Rows are fetched in chunks as
+    they are iterated over, rather than all at once.
+    """
+    cur = connect().execute(sql, data)
+    for rows in iter(lambda: cur.fetchmany(size), []):
+        yield from rows
 
 
 def create_users_table() -> None:
@@ -64,14 +132,22 @@ def create_users_table() -> None:
         phone text,
         photo_url text,
         challenge text,
-        challenge_datetime timestamp,
+        challenge_datetime integer,
         can_play_game boolean
     );"""
-    conn = sqlite3.connect(database)
-    cur = conn.cursor()
-    cur.execute(sql)
-    conn.commit()
-    conn.close()
+    # Older databases stored challenge datetimes as strings, these
+    # challenges are long expired so we can just clear them
+    migrate_sql = """UPDATE users SET challenge = NULL, challenge_datetime = NULL
+        WHERE typeof(challenge_datetime) = 'text';"""
+    # Used to find overdue challenges, slack_channel is already indexed
+    # by its unique constraint
+    index_sql = """CREATE INDEX IF NOT EXISTS idx_users_challenge_datetime
+        ON users(challenge_datetime) WHERE challenge IS NOT NULL;"""
+    conn = connect()
+    with conn:
+        conn.execute(sql)
+        conn.execute(migrate_sql)
+        conn.execute(index_sql)
 
 
 def create_challenges_table() -> None:
@@ -86,8 +162,18 @@ def create_challenges_table() -> None:
         challenge text NOT NULL,
         FOREIGN KEY(slack_id) REFERENCES users(slack_id)
     );"""
-    conn = sqlite3.connect(database)
-    cur = conn.cursor()
-    cur.execute(sql)
-    conn.commit()
-    conn.close()
+    index_sql = """CREATE INDEX IF NOT EXISTS idx_challenges_slack_id
+        ON challenges(slack_id);"""
+    conn = connect()
+    with conn:
+        conn.execute(sql)
+        conn.execute(index_sql)
+
+
+def init_schema() -> None:
+    """
+    Create all tables if they dont exist. Should be run once when
+    the bot starts up, before users are synced.
+    """
+    create_users_table()
+    create_challenges_table()
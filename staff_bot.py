@@ -1,8 +1,13 @@
 import sys
 
 import settings as s
-from classes import MonitorSlack, ProcessQueue, ScheduleThread
-from sql import create_challenges_table
+from classes import (
+    MonitorSlack,
+    ProcessQueue,
+    ScheduleThread,
+    SlackSender,
+)
+from sql import init_schema
 from utils import get_users_from_slack
 
 # Requirements
@@ -12,15 +17,18 @@ assert s.SLACK_BOT_OAUTH_ACCESS_TOKEN, "Missing Secret: SLACK_BOT_OAUTH_ACCESS_T
 if __name__ == "__main__":
     # Connect to Slack
     s.slack_init()
+    # Create tables if they dont exist
+    init_schema()
 
     # On initial connect, get all users from Slack
     get_users_from_slack()
-    # Create table if it doesnt exist
-    create_challenges_table()
 
     # Gets events from Slack
     monitor_slack = MonitorSlack()
     monitor_slack.start()
+    # Sends our messages to Slack
+    slack_sender = SlackSender()
+    slack_sender.start()
     # Process events and react if we need to
     process_queue = ProcessQueue()
     process_queue.start()
@@ -1,15 +1,37 @@
-from typing import Dict, List
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, TextIO, Tuple
 
 # Third party
 import cv2
 import requests
+from requests.adapters import HTTPAdapter
 from loguru import logger
 import numpy as np
 
 # Local
 import settings as s
 from models import User
-from sql import create_users_table
+
+# Avatars are all served from the same few hosts, keep connections to them
+# alive between users
+_AVATAR_SESSION = requests.Session()
+_AVATAR_SESSION.mount(
+    "https://",
+    HTTPAdapter(pool_connections=4, pool_maxsize=s.FACE_DETECTION_WORKERS),
+)
+# Largest width or height of avatars to check for faces, Slack's are 192px
+_MAX_AVATAR_SIZE = 256
+# Face classifiers for each face detection thread
+_CASCADES = threading.local()
+# Users we can't open a direct channel with, for example if the bot doesn't
+# have the im:write scope or they are external users, so that we don't keep
+# asking Slack for them
+_UNREACHABLE_USERS: Set[str] = set()
 
 
 @logger.catch
@@ -19,42 +41,33 @@ def get_users_from_slack() -> None:
     users and delete any disabled users from the database.
     """
 
-    # Create users table if it doesnt exist
-    create_users_table()
-
-    # Get all users IM channels with bot
-    channels = get_slack_users_channels()
-
-    # Get 100 users from Slack at a time (Slacks recommendation), its
-    # paginated, so we loop until we get all users
-    users: List = []
-    slack_users = s.SLACK_CLIENT.api_call("users.list", limit=100)
-    has_more = True
-    while has_more:
-        if slack_users["ok"]:
-            if slack_users["members"]:
-                users.extend(slack_users["members"])
-            # If this is null, we've looped through all pages
-            has_more = bool(slack_users["response_metadata"]["next_cursor"])
-            if has_more:
-                # Get next page
-                cursor = slack_users["response_metadata"]["next_cursor"]
-                slack_users = s.SLACK_CLIENT.api_call(
-                    "users.list", cursor=cursor, limit=100
-                )
-        else:
-            # Something went wrong
-            has_more = False
-    # Update DB
-    for user in users:
-        current_user = User.parse_slack_data(user)
-        if current_user and is_active_slack_user(user):
-            # Get their Slack channel
-            current_user.slack_channel = channels.get(current_user.slack_id)
-            current_user.save()
-        elif current_user:
-            # Remove user from DB if they aren't active
-            current_user.delete()
+    # Users IM channels with bot never change, so we keep the ones we have.
+    # Channels for other users are only opened once we need to message them
+    channels = User.get_saved_channels()
+    # Users that haven't changed don't need to be saved again, they keep their
+    # challenges and face detection
+    saved_profiles = User.get_saved_profiles()
+
+    # Disabled users are removed a page at a time as we get them from Slack,
+    # but active users are only saved once all of them are removed, as Slack
+    # can give a new user the email address of a disabled one
+    active_users = []
+    for users in get_slack_users():
+        inactive_users = []
+        for user in users:
+            if not is_active_slack_user(user):
+                # Remove user from DB if they aren't active, only needs their ID
+                if user.get("id"):
+                    inactive_users.append(user["id"].upper())
+                continue
+            current_user = User.parse_slack_data(user)
+            if current_user:
+                # Get their Slack channel
+                current_user.slack_channel = channels.get(current_user.slack_id)
+                if current_user.profile not in saved_profiles:
+                    active_users.append(current_user)
+        User.bulk_delete(inactive_users)
+    User.bulk_save(active_users)
 
     # Update all users profiles if they have a face in their avatar
     if s.ENABLE_FACE_DETECTION:
@@ -63,36 +76,170 @@ def get_users_from_slack() -> None:
     logger.info(f"Successfully updated users from Slack.")
 
 
-@logger.catch
-def get_slack_users_channels() -> Dict[str, str]:
+def slack_api_call(method: str, **kwargs: Any) -> Dict:
     """
-    Get all direct channels for users on Slack to be stored in DB,
-    this will allow us to immediately message users without needing
-    to get their channel from Slack.
+    Call a Slack Web API method, if Slack rate limits us we wait for as
+    long as it asks and then try again.
+    """
+    response = s.SLACK_CLIENT.api_call(method, **kwargs)
+    for attempt in range(s.SLACK_API_RETRIES):
+        if response.get("error") != "ratelimited":
+            break
+        # Slack tells us how long to wait, back off further if it doesn't
+        headers = {
+            key.lower(): value for key, value in response.get("headers", {}).items()
+        }
+        delay = int(headers.get("retry-after", 2**attempt))
+        logger.warning(f"Rate limited by Slack on {method}, retrying in {delay}s.")
+        time.sleep(delay)
+        response = s.SLACK_CLIENT.api_call(method, **kwargs)
+    return response
+
+
+def get_slack_users() -> Iterator[List[Dict]]:
+    """
+    Get all users on Slack a page at a time, so that we never need to hold
+    all of them at once. users.list is heavily rate limited so we use our
+    cached copy of the users if it is recent enough.
+    """
+    cached_users = load_cached_slack_users()
+    if cached_users is not None:
+        logger.info("Using cached users from Slack.")
+        yield from cached_users
+        return
+
+    cache = SlackUsersCacheWriter()
+    try:
+        # Get 1000 users from Slack at a time (the most Slack allows), its
+        # paginated, so we loop until we get all users. We don't need their
+        # locale, so make sure Slack leaves it out
+        slack_users = slack_api_call("users.list", limit=1000, include_locale="false")
+        has_more = True
+        while has_more:
+            if slack_users["ok"]:
+                users = slack_users["members"] or []
+                cache.write(users)
+                yield users
+                # If this is null, we've looped through all pages
+                has_more = bool(slack_users["response_metadata"]["next_cursor"])
+                if has_more:
+                    # Get next page
+                    cursor = slack_users["response_metadata"]["next_cursor"]
+                    slack_users = slack_api_call(
+                        "users.list",
+                        cursor=cursor,
+                        limit=1000,
+                        include_locale="false",
+                    )
+            else:
+                # Something went wrong, don't cache incomplete users
+                return
+        cache.save()
+    finally:
+        cache.close()
+
+
+def load_cached_slack_users() -> Optional[Iterator[List[Dict]]]:
+    """
+    Load users from our cached copy of users.list, if we have one for
+    this bot that hasn't expired. The first line of the cache describes
+    it, followed by a line per page of users.
+    """
+    try:
+        f = open(s.SLACK_USERS_CACHE_LOCATION)
+    except OSError:
+        return None
+    try:
+        cache = json.loads(f.readline())
+    except ValueError:
+        cache = {}
+    if (
+        cache.get("bot_id") != s.STAFF_BOT_ID
+        or time.time() - cache.get("time", 0) > s.SLACK_USERS_CACHE_TIMEOUT
+    ):
+        f.close()
+        return None
+    return read_cached_slack_users(f)
+
+
+def read_cached_slack_users(f: TextIO) -> Iterator[List[Dict]]:
+    """
+    Read the pages of users from our cache, closing it once we are done.
+    """
+    with f:
+        for line in f:
+            yield json.loads(line)
+
+
+class SlackUsersCacheWriter:
+    """
+    Saves a copy of users.list a page at a time, written to a temporary file
+    first so that the cache is only replaced once we have all the users.
+    Failing to write the cache only logs a warning.
     """
-    # Get 100 channels from Slack at a time (Slacks recommendation), its
-    # paginated, so we loop until we get all channels
-    channels = {}
-    slack_channels = s.SLACK_CLIENT.api_call(
-        "conversations.list", types="im", limit=100
-    )
-    has_more = True
-    while has_more:
-        if slack_channels["ok"]:
-            for channel in slack_channels["channels"]:
-                channels[channel["user"]] = channel["id"]
-            # If this is null, we've looped through all pages
-            has_more = bool(slack_channels["response_metadata"]["next_cursor"])
-            if has_more:
-                # Get next page
-                cursor = slack_channels["response_metadata"]["next_cursor"]
-                slack_channels = s.SLACK_CLIENT.api_call(
-                    "conversations.list", types="im", cursor=cursor, limit=100
-                )
-        else:
-            # Something went wrong
-            has_more = False
-    return channels
+
+    def __init__(self) -> None:
+        self.temp_location = s.SLACK_USERS_CACHE_LOCATION.with_suffix(".tmp")
+        self.file: Optional[TextIO] = None
+        if s.SLACK_USERS_CACHE_TIMEOUT <= 0:
+            return
+        cache = {"bot_id": s.STAFF_BOT_ID, "time": time.time()}
+        try:
+            self.file = open(self.temp_location, "w")
+            self.file.write(json.dumps(cache) + "\n")
+        except OSError as e:
+            self.fail(e)
+
+    def write(self, users: List[Dict]) -> None:
+        if self.file:
+            try:
+                self.file.write(json.dumps(users) + "\n")
+            except OSError as e:
+                self.fail(e)
+
+    def save(self) -> None:
+        if self.file:
+            try:
+                self.file.close()
+                os.replace(self.temp_location, s.SLACK_USERS_CACHE_LOCATION)
+            except OSError as e:
+                self.fail(e)
+            self.file = None
+
+    def close(self) -> None:
+        """
+        Discard the cache if it wasn't saved.
+        """
+        if self.file:
+            self.file.close()
+            self.file = None
+            try:
+                os.remove(self.temp_location)
+            except OSError:
+                pass
+
+    def fail(self, error: OSError) -> None:
+        logger.warning(f"Couldn't cache users from Slack: {error}")
+        self.close()
+
+
+def open_slack_channel(slack_id: str) -> Optional[str]:
+    """
+    Get the direct channel for a user on Slack to be stored in DB, this
+    will allow us to immediately message users without needing to get
+    their channel from Slack. Opening a channel that already exists
+    returns the existing one.
+    """
+    if slack_id in _UNREACHABLE_USERS:
+        return None
+    response = slack_api_call("conversations.open", users=slack_id)
+    if not response["ok"]:
+        logger.error(f"Couldn't open channel for {slack_id}: {response.get('error')}")
+        # Only being rate limited is worth trying again
+        if response.get("error") != "ratelimited":
+            _UNREACHABLE_USERS.add(slack_id)
+        return None
+    return response["channel"]["id"]
 
 
 @logger.catch
@@ -105,16 +252,15 @@ def is_active_slack_user(user: Dict) -> bool:
 
     See https://api.slack.com/types/user
     """
-    if not user.get("deleted") and not user.get("is_bot"):
-        profile = user.get("profile")
-        if profile:
-            if profile.get("email"):
-                return True
-    return False
+    return bool(
+        not user.get("deleted")
+        and not user.get("is_bot")
+        and (user.get("profile") or {}).get("email")
+    )
 
 
 @logger.catch
-def detect_face(users: List) -> None:
+def detect_face(users: Iterable[User]) -> None:
     """
     Uses two Haar Classifiers to try and determine if there is a face
     present in the users Slack avatar - if face detection is enabled. Its
@@ -122,34 +268,79 @@ def detect_face(users: List) -> None:
     Slack and super obvious pictures that won't be able to help users determine
     who it is.
     """
-    # We use two classifiers to try and determine if there is a face present
-    cascades = [
-        cv2.CascadeClassifier(
-            f"{cv2.data.haarcascades}haarcascade_frontalface_default.xml"
-        ),
-        cv2.CascadeClassifier(f"{cv2.data.haarcascades}haarcascade_profileface.xml"),
-    ]
-    # Go through all users and ensure they are valid for the guessing game
+    # Many users share the same stock avatar, only check each one once. Only
+    # keep what we need of each user, so that we never hold all of them
+    avatars: Dict[str, List[Tuple[str, bool]]] = {}
     for user in users:
-        can_play_game = False
-        for cascade in cascades:
-            if can_play_game:
-                # Don't need to look further
-                break
-            # Retrieve image
-            r = requests.get(user.photo_url)
-            r.raise_for_status()
-            # Convert to numpy array so that we can decode it
-            image = np.asarray(bytearray(r.content), dtype="uint8")
-            image = cv2.imdecode(image, cv2.IMREAD_COLOR)
-            # Convert to grey scale for cv2 recognition
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            # Detect faces in the image
-            faces_found = cascade.detectMultiScale(
-                gray, scaleFactor=1.05, minNeighbors=5, minSize=(30, 30)
-            )
-            if len(faces_found) > 0:
-                can_play_game = True
-        # Save to DB
-        user.can_play_game = can_play_game
-        user.save()
+        avatars.setdefault(user.photo_url, []).append(
+            (user.slack_id, user.can_play_game)
+        )
+    photo_urls = list(avatars)
+    # Go through all avatars and ensure users are valid for the guessing game,
+    # downloading and detection release the GIL so avatars are checked in parallel
+    with ThreadPoolExecutor(max_workers=s.FACE_DETECTION_WORKERS) as executor:
+        faces = dict(zip(photo_urls, executor.map(check_face, photo_urls)))
+    # Save to DB only the users whose result changed, users whose avatar
+    # couldn't be checked keep their last result
+    User.bulk_set_can_play_game(
+        (slack_id, face)
+        for photo_url, face in faces.items()
+        if face is not None
+        for slack_id, can_play_game in avatars[photo_url]
+        if face != can_play_game
+    )
+
+
+def check_face(photo_url: str) -> Optional[bool]:
+    """
+    See if there is a face in an avatar, returns None if we couldn't check
+    it so that one broken avatar doesn't stop us from checking the rest.
+    Failures aren't cached, we try again on the next sync.
+    """
+    try:
+        return has_face(photo_url)
+    except Exception as e:
+        logger.warning(f"Couldn't check avatar {photo_url} for a face: {e}")
+        return None
+
+
+@lru_cache(maxsize=2048)
+def has_face(photo_url: str) -> bool:
+    """
+    Download an avatar and check if either of our classifiers can find a
+    face in it. Results are cached, as avatars get a new URL when they
+    change.
+    """
+    # Classifiers aren't safe to share between threads, so each thread
+    # loads its own
+    cascades = getattr(_CASCADES, "cascades", None)
+    if cascades is None:
+        # We use two classifiers to try and determine if there is a face present
+        cascades = _CASCADES.cascades = [
+            cv2.CascadeClassifier(
+                f"{cv2.data.haarcascades}haarcascade_frontalface_default.xml"
+            ),
+            cv2.CascadeClassifier(
+                f"{cv2.data.haarcascades}haarcascade_profileface.xml"
+            ),
+        ]
+    # Retrieve image
+    r = _AVATAR_SESSION.get(photo_url)
+    r.raise_for_status()
+    # Decode straight to grey scale for cv2 recognition, without copying
+    gray = cv2.imdecode(np.frombuffer(r.content, dtype="uint8"), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise ValueError("Avatar is not an image")
+    # Detection gets slower with every pixel, shrink larger avatars
+    scale = _MAX_AVATAR_SIZE / max(gray.shape)
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    for cascade in cascades:
+        # Detect faces in the image
+        faces_found = cascade.detectMultiScale(
+            gray, scaleFactor=1.05, minNeighbors=5, minSize=(30, 30)
+        )
+        if len(faces_found) > 0:
+            # Don't need to look further
+            return True
+    return False